@@ -1,15 +1,29 @@
 # api_server.py
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Header, Query
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Header, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse
+from starlette.concurrency import run_in_threadpool
+from contextlib import contextmanager
 import sqlite3
+import asyncio
+import queue
+import time
 import os
-from datetime import datetime
+import aiofiles
+import aiofiles.os
+import orjson
+from datetime import date, datetime, timedelta
 import uvicorn
 from pathlib import Path
 
-app = FastAPI(title="Raspberry Pi Data Receiver", version="1.0.0")
+class ORJSONResponse(JSONResponse):
+    """Respuesta JSON serializada con orjson (mucho más rápido que json.dumps)"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+app = FastAPI(title="Raspberry Pi Data Receiver", version="1.0.0", default_response_class=ORJSONResponse)
 
 # CORS para permitir conexiones desde Streamlit
 app.add_middleware(
@@ -22,65 +36,297 @@ app.add_middleware(
 
 # Crear directorios necesarios
 IMAGES_DIR = "images"
+IMAGES_DIR_PATH = Path(IMAGES_DIR)
+COPY_BUFFER_SIZE = 1024 * 1024  # escribir imágenes en bloques de 1 MiB
+IMAGE_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n")  # JPEG, PNG
+ALLOWED_EXTENSIONS = frozenset({'jpg', 'jpeg', 'png'})
+# Cada imagen tiene un nombre único con timestamp y nunca se sobrescribe
+IMAGE_CACHE_CONTROL = "public, max-age=86400, immutable"
 os.makedirs(IMAGES_DIR, exist_ok=True)
 os.makedirs("static", exist_ok=True)
 
+class ImageStaticFiles(StaticFiles):
+    """StaticFiles con cabeceras de caché largas para las imágenes"""
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = IMAGE_CACHE_CONTROL
+        return response
+
 # Servir archivos estáticos (imágenes) - SOLO UNA RUTA
-app.mount("/images", StaticFiles(directory=IMAGES_DIR), name="images")
+app.mount("/images", ImageStaticFiles(directory=IMAGES_DIR, check_dir=False), name="images")
 
 # Base de datos
+DB_PATH = 'raspberry_data.db'
+OPTIMIZE_INTERVAL = 15 * 60  # segundos entre cada PRAGMA optimize
+POOL_SIZE = 8
+STATEMENT_CACHE_SIZE = 128  # sentencias preparadas que se reutilizan por conexión
+
+# Conexiones reutilizadas entre requests (mantienen caliente el page cache)
+_pool = queue.Queue()
+
+# Marca de la última escritura confirmada; es el ETag de los endpoints de lectura
+_data_version = time.time_ns()
+
+def _open_conn():
+    """Abrir conexión SQLite con los PRAGMA de rendimiento (son por conexión)"""
+    # isolation_level=None: las transacciones se abren explícitamente con transaction()
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None,
+                           cached_statements=STATEMENT_CACHE_SIZE)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA cache_size=-20000")
+    return conn
+
+def init_pool():
+    for _ in range(POOL_SIZE):
+        _pool.put(_open_conn())
+
+def close_pool():
+    while not _pool.empty():
+        _pool.get_nowait().close()
+
+@contextmanager
+def get_conn():
+    """Tomar prestada una conexión del pool y devolverla al terminar"""
+    conn = _pool.get()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        _pool.put(conn)
+
+@contextmanager
+def transaction(conn):
+    """Agrupar varias escrituras en una sola transacción (un solo fsync)"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+    mark_data_changed()
+
+def mark_data_changed():
+    global _data_version
+    _data_version = time.time_ns()
+
+def not_modified(request: Request, response: Response):
+    """Devolver 304 si el cliente ya tiene la versión actual de los datos"""
+    etag = f'"{_data_version:x}"'
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    return None
+
+# Resultados de lectura ya calculados, válidos mientras no haya escrituras nuevas
+_results_cache = {}
+
+def cached_by_version(key, load):
+    """Reutilizar el resultado de load() hasta la próxima escritura confirmada"""
+    version = _data_version  # antes de consultar: si hay una escritura en medio, se recalcula
+    entry = _results_cache.get(key)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    data = load()
+    _results_cache[key] = (version, data)
+    return data
+
+def optimize_db():
+    """Actualizar estadísticas del planificador de consultas"""
+    with get_conn() as conn:
+        conn.execute("PRAGMA optimize")
+
+async def periodic_optimize():
+    while True:
+        await asyncio.sleep(OPTIMIZE_INTERVAL)
+        await run_in_threadpool(optimize_db)
+
+# Consultas SQL del camino caliente: al ser cadenas constantes, cada conexión
+# del pool las compila una sola vez y luego reutiliza la sentencia preparada
+# Registrar el Raspberry Pi solo si es nuevo (sin consultar antes si existe)
+INSERT_RPI_SQL = '''
+    INSERT OR IGNORE INTO raspberry_info (raspberry_id, name, location, latitude, longitude, last_seen, status)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+INSERT_DETECTION_SQL = '''
+    INSERT INTO detections 
+    (raspberry_id, timestamp, detection_count, temperature, humidity, 
+     latitude, longitude, image_filename, image_url)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+UPDATE_RPI_SQL = '''
+    UPDATE raspberry_info 
+    SET last_seen = ?, latitude = ?, longitude = ?, location = ?,
+        total_detections = total_detections + ?, last_detection = ?
+    WHERE raspberry_id = ?
+'''
+
+# Los totales por Raspberry Pi se mantienen en raspberry_info al insertar,
+# así esta consulta no necesita JOIN ni GROUP BY sobre detections
+LOCATIONS_SQL = '''
+    SELECT raspberry_id, name, location, latitude, longitude, 
+           last_seen, status, total_detections, last_detection
+    FROM raspberry_info
+    ORDER BY raspberry_id
+'''
+
+# Recalcular los totales desde detections (migración y borrados parciales)
+REFRESH_RPI_TOTALS_SQL = '''
+    UPDATE raspberry_info SET
+        total_detections = COALESCE((SELECT SUM(d.detection_count) FROM detections d
+                                     WHERE d.raspberry_id = raspberry_info.raspberry_id), 0),
+        last_detection = (SELECT MAX(d.timestamp) FROM detections d
+                          WHERE d.raspberry_id = raspberry_info.raspberry_id)
+'''
+
+RPI_IMAGES_SQL = '''
+    SELECT id, timestamp, detection_count, image_filename, 
+           image_url, temperature, humidity
+    FROM detections 
+    WHERE raspberry_id = ?
+    ORDER BY timestamp DESC 
+    LIMIT ?
+'''
+
+LATEST_DATA_SQL = '''
+    SELECT id, raspberry_id, timestamp, detection_count,
+           temperature, humidity, latitude, longitude,
+           image_filename, image_url, created_at
+    FROM detections 
+    ORDER BY timestamp DESC 
+    LIMIT ?
+'''
+
+# Paginación por keyset: la siguiente página empieza en el último timestamp recibido
+LATEST_DATA_BEFORE_SQL = '''
+    SELECT id, raspberry_id, timestamp, detection_count,
+           temperature, humidity, latitude, longitude,
+           image_filename, image_url, created_at
+    FROM detections 
+    WHERE timestamp < ?
+    ORDER BY timestamp DESC 
+    LIMIT ?
+'''
+
+# Un solo recorrido de detections: agregados por Raspberry Pi, los totales
+# generales se suman en Python sobre esas pocas filas (COUNT y SUM ignoran los NULL)
+STATS_BY_PI_SQL = '''
+    SELECT raspberry_id, COUNT(*) as count,
+           SUM(temperature) as temperature_sum, COUNT(temperature) as temperature_count,
+           SUM(humidity) as humidity_sum, COUNT(humidity) as humidity_count
+    FROM detections
+    GROUP BY raspberry_id
+    ORDER BY count DESC
+'''
+
+# Raspberry Pi de ejemplo: (raspberry_id, name, location, latitude, longitude, status)
+SEED_RASPBERRIES = [
+    ('DIRIS_LIMA', 'Raspberry Pi DIRIS', 'El Agustino', -12.0407, -76.9951, 'online'),
+    ('UPC_MONTERRICO', 'Raspberry Pi UPC', 'Monterrico', -12.1037, -76.9630, 'online'),
+    ('RPI_MOLINA', 'Raspberry Pi Molina', 'La Molina', -12.0729, -76.9691, 'offline'),
+]
+
+SEED_RPI_SQL = '''
+    INSERT OR IGNORE INTO raspberry_info 
+    (raspberry_id, name, location, latitude, longitude, last_seen, status)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
 def init_db():
-    conn = sqlite3.connect('raspberry_data.db')
+    conn = _open_conn()
     cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS detections (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            raspberry_id TEXT,
-            timestamp TEXT,
-            detection_count INTEGER,
-            temperature REAL,
-            humidity REAL,
-            latitude REAL,
-            longitude REAL,
-            image_filename TEXT,
-            image_url TEXT,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Tabla para información de Raspberry Pi
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS raspberry_info (
-            raspberry_id TEXT PRIMARY KEY,
-            name TEXT,
-            location TEXT,
-            latitude REAL,
-            longitude REAL,
-            last_seen TEXT,
-            status TEXT DEFAULT 'active'
-        )
-    ''')
-    
-    # Insertar 3 Raspberry Pi de ejemplo si no existen
-    cursor.execute('''
-        INSERT OR IGNORE INTO raspberry_info 
-        (raspberry_id, name, location, latitude, longitude, last_seen, status)
-        VALUES 
-        ('DIRIS_LIMA', 'Raspberry Pi DIRIS', 'El Agustino', -12.0407, -76.9951, ?, 'online'),
-        ('UPC_MONTERRICO', 'Raspberry Pi UPC', 'Monterrico', -12.1037, -76.9630, ?, 'online'),
-        ('RPI_MOLINA', 'Raspberry Pi Molina', 'La Molina', -12.0729, -76.9691, ?, 'offline')
-    ''', (datetime.now().isoformat(), datetime.now().isoformat(), datetime.now().isoformat()))
-    
-    conn.commit()
+    # WAL es persistente en el archivo: lectores y escritor ya no se bloquean
+    cursor.execute("PRAGMA journal_mode=WAL")
+
+    # Esquema y datos de ejemplo en una sola transacción (un solo fsync)
+    with transaction(conn):
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS detections (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                raspberry_id TEXT,
+                timestamp TEXT,
+                detection_count INTEGER,
+                temperature REAL,
+                humidity REAL,
+                latitude REAL,
+                longitude REAL,
+                image_filename TEXT,
+                image_url TEXT,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Índices para los ORDER BY timestamp / filtros por raspberry_id de los endpoints de lectura
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_det_rpi_ts ON detections(raspberry_id, timestamp DESC)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_det_ts ON detections(timestamp DESC)')
+
+        # Tabla para información de Raspberry Pi
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS raspberry_info (
+                raspberry_id TEXT PRIMARY KEY,
+                name TEXT,
+                location TEXT,
+                latitude REAL,
+                longitude REAL,
+                last_seen TEXT,
+                status TEXT DEFAULT 'active',
+                total_detections INTEGER DEFAULT 0,
+                last_detection TEXT
+            )
+        ''')
+
+        # Bases de datos anteriores: añadir los totales y calcularlos una vez
+        cursor.execute('PRAGMA table_info(raspberry_info)')
+        if 'total_detections' not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE raspberry_info ADD COLUMN total_detections INTEGER DEFAULT 0')
+            cursor.execute('ALTER TABLE raspberry_info ADD COLUMN last_detection TEXT')
+            cursor.execute(REFRESH_RPI_TOTALS_SQL)
+
+        # Insertar los Raspberry Pi de ejemplo solo si la tabla está vacía
+        cursor.execute('SELECT 1 FROM raspberry_info LIMIT 1')
+        if cursor.fetchone() is None:
+            now_iso = datetime.now().isoformat()
+            cursor.executemany(SEED_RPI_SQL, [
+                (raspberry_id, name, location, latitude, longitude, now_iso, status)
+                for raspberry_id, name, location, latitude, longitude, status in SEED_RASPBERRIES
+            ])
+
+    # Estadísticas frescas para que el planificador elija los índices
+    # (analysis_limit acota el costo en tablas grandes)
+    cursor.execute("PRAGMA analysis_limit=400")
+    cursor.execute("ANALYZE")
     conn.close()
 
+def rows_as_columns(cursor):
+    """Formato columnar: los nombres de columna una sola vez y cada fila como lista"""
+    return {
+        "columns": [column[0] for column in cursor.description],
+        "rows": [tuple(row) for row in cursor.fetchall()]
+    }
+
 @app.on_event("startup")
 async def startup_event():
     init_db()
+    init_pool()
+    app.state.optimize_task = asyncio.create_task(periodic_optimize())
     print("🚀 FastAPI server started successfully!")
     print("📊 Database initialized")
     print("📂 Static files directory created")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    app.state.optimize_task.cancel()
+    optimize_db()
+    close_pool()
+
 @app.get("/")
 async def root():
     return {"message": "Raspberry Pi Data Receiver API", "status": "running"}
@@ -90,6 +336,67 @@ async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "timestamp": datetime.now().isoformat()}
 
+def save_detection(raspberry_id, name, location, detection_count,
+                   temperature, humidity, latitude, longitude, image_filename, image_url, now_iso):
+    """Registrar una detección y actualizar el estado del Raspberry Pi"""
+    with get_conn() as conn, transaction(conn):
+        cursor = conn.cursor()
+        # Si el Raspberry Pi no existe, lo insertamos
+        cursor.execute(INSERT_RPI_SQL, (
+            raspberry_id,
+            name,  
+            location,
+            latitude,
+            longitude,
+            now_iso,
+            "online"
+        ))
+        
+        # Insertar detección
+        cursor.execute(INSERT_DETECTION_SQL, (
+            raspberry_id, 
+            now_iso,
+            detection_count,
+            temperature,
+            humidity,
+            latitude,
+            longitude,
+            image_filename,
+            image_url
+        ))
+
+        # Actualizar última conexión y totales del Raspberry Pi
+        cursor.execute(UPDATE_RPI_SQL, (
+            now_iso,
+            latitude,
+            longitude,
+            location,
+            detection_count,
+            now_iso,
+            raspberry_id
+        ))
+
+def image_subdir(raspberry_id, timestamp):
+    """Subdirectorio de una imagen: {raspberry_id}/{YYYYMM}, para no acumular todo en una carpeta"""
+    return os.path.join(raspberry_id, timestamp[:6])
+
+def locate_image(image_filename):
+    """Devolver (ruta, stat) de una imagen o (None, None) si no existe"""
+    candidates = [os.path.join(IMAGES_DIR, image_filename)]  # imágenes antiguas, sin subdirectorio
+    try:
+        # Los nombres tienen la forma {raspberry_id}_{YYYYMMDD}_{HHMMSS}_{ms}.{ext}
+        raspberry_id, day, _, _ = os.path.splitext(image_filename)[0].rsplit('_', 3)
+        candidates.insert(0, os.path.join(IMAGES_DIR, image_subdir(raspberry_id, day), image_filename))
+    except ValueError:
+        pass
+    
+    for image_path in candidates:
+        try:
+            return image_path, os.stat(image_path)
+        except FileNotFoundError:
+            continue
+    return None, None
+
 @app.post("/api/raspberry-data")
 async def receive_raspberry_data(
     raspberry_id: str = Form(...),
@@ -103,73 +410,49 @@ async def receive_raspberry_data(
     image: UploadFile = File(...)
 ):
     try:
+        # raspberry_id se usa como nombre de directorio
+        if not raspberry_id or raspberry_id.startswith('.') or '/' in raspberry_id or '\\' in raspberry_id:
+            raise HTTPException(status_code=400, detail="raspberry_id inválido")
+        
         # Validar el archivo de imagen
         if not image.content_type.startswith('image/'):
             raise HTTPException(status_code=400, detail="El archivo debe ser una imagen")
         
+        # El content-type lo decide el cliente: verificar la firma en los primeros bytes
+        head = await image.read(16)
+        await image.seek(0)
+        if not head.startswith(IMAGE_SIGNATURES):
+            raise HTTPException(status_code=400, detail="El archivo debe ser una imagen JPEG o PNG")
+        
         # Crear nombre único para la imagen
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
-        image_extension = image.filename.split('.')[-1] if '.' in image.filename else 'jpg'
+        now = datetime.now()
+        now_iso = now.isoformat()
+        timestamp = now.strftime("%Y%m%d_%H%M%S_%f")[:-3]
+        image_extension = os.path.splitext(image.filename or '')[1].lstrip('.').lower() or 'jpg'
+        if image_extension not in ALLOWED_EXTENSIONS:
+            raise HTTPException(status_code=400, detail=f"Extensión no permitida: {image_extension}")
         image_filename = f"{raspberry_id}_{timestamp}.{image_extension}"
-        image_path = os.path.join(IMAGES_DIR, image_filename)
+        subdir = image_subdir(raspberry_id, timestamp)
+        image_dir = IMAGES_DIR_PATH / subdir
+        await aiofiles.os.makedirs(image_dir, exist_ok=True)
+        image_path = image_dir / image_filename
         
-        # Guardar imagen
-        with open(image_path, "wb") as f:
-            content = await image.read()
-            f.write(content)
+        # Guardar imagen por bloques, sin cargarla completa en memoria
+        async with aiofiles.open(image_path, "wb") as f:
+            while chunk := await image.read(COPY_BUFFER_SIZE):
+                await f.write(chunk)
         
         # Crear URL completa para la imagen
         # En producción, usa tu dominio de Render
         # En desarrollo, usa localhost
         base_url = os.getenv("BASE_URL")
-        image_url = f"{base_url}/images/{image_filename}"
+        image_url = f"{base_url}/images/{subdir}/{image_filename}"
         
-        # Guardar en base de datos
-        conn = sqlite3.connect('raspberry_data.db')
-        cursor = conn.cursor()
-        # Verificar si el Raspberry Pi ya existe, si no, lo insertamos
-        cursor.execute('SELECT COUNT(*) FROM raspberry_info WHERE raspberry_id = ?', (raspberry_id,))
-        if cursor.fetchone()[0] == 0:
-            cursor.execute('''
-                INSERT INTO raspberry_info (raspberry_id, name, location, latitude, longitude, last_seen, status)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                raspberry_id,
-                name,  
-                location,
-                latitude,
-                longitude,
-                datetime.now().isoformat(),
-                "online"
-            ))
-            
-        # Insertar detección
-        cursor.execute('''
-            INSERT INTO detections 
-            (raspberry_id, timestamp, detection_count, temperature, humidity, 
-             latitude, longitude, image_filename, image_url)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            raspberry_id, 
-            datetime.now().isoformat(),
-            detection_count,
-            temperature,
-            humidity,
-            latitude,
-            longitude,
-            image_filename,
-            image_url
-        ))
-        
-        # Actualizar última conexión del Raspberry Pi
-        cursor.execute('''
-            UPDATE raspberry_info 
-            SET last_seen = ?, latitude = ?, longitude = ?, location = ?
-            WHERE raspberry_id = ?
-        ''', (datetime.now().isoformat(), latitude, longitude, raspberry_id,location))
-        
-        conn.commit()
-        conn.close()
+        # Guardar en base de datos (fuera del event loop)
+        await run_in_threadpool(
+            save_detection, raspberry_id, name, location, detection_count,
+            temperature, humidity, latitude, longitude, image_filename, image_url, now_iso
+        )
         
         print(f"✅ Datos recibidos de {raspberry_id}: {detection_count} detecciones")
         print(f"🖼️ Imagen guardada: {image_url}")
@@ -182,101 +465,92 @@ async def receive_raspberry_data(
             "detections": detection_count
         }
     
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"❌ Error procesando datos de {raspberry_id}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error processing data: {str(e)}")
         
-@app.get("/api/raspberry-locations")
-async def get_raspberry_locations():
-    """Obtener ubicaciones de todos los Raspberry Pi"""
-    conn = sqlite3.connect('raspberry_data.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT r.raspberry_id, r.name, r.location, r.latitude, r.longitude, 
-               r.last_seen, r.status,
-               SUM(d.detection_count) as total_detections,
-               MAX(d.timestamp) as last_detection
-        FROM raspberry_info r
-        LEFT JOIN detections d ON r.raspberry_id = d.raspberry_id
-        GROUP BY r.raspberry_id
-    ''')
-    
-    columns = ['raspberry_id', 'name', 'location', 'latitude', 'longitude', 
-               'last_seen', 'status', 'total_detections', 'last_detection']
-    data = [dict(zip(columns, row)) for row in cursor.fetchall()]
-    conn.close()
+def load_raspberry_locations():
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(LOCATIONS_SQL)
+        
+        data = [dict(row) for row in cursor.fetchall()]
     
     return {"raspberry_locations": data}
 
+@app.get("/api/raspberry-locations")
+def get_raspberry_locations(request: Request, response: Response):
+    """Obtener ubicaciones de todos los Raspberry Pi"""
+    cached = not_modified(request, response)
+    if cached:
+        return cached
+    return cached_by_version("raspberry_locations", load_raspberry_locations)
+
 @app.get("/api/raspberry-images/{raspberry_id}")
-async def get_raspberry_images(raspberry_id: str, limit: int = 20):
+def get_raspberry_images(
+    request: Request,
+    response: Response,
+    raspberry_id: str,
+    limit: int = 20,
+    columnar: bool = False
+):
     """Obtener imágenes de un Raspberry Pi específico"""
-    conn = sqlite3.connect('raspberry_data.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT id, timestamp, detection_count, image_filename, 
-               image_url, temperature, humidity
-        FROM detections 
-        WHERE raspberry_id = ?
-        ORDER BY timestamp DESC 
-        LIMIT ?
-    ''', (raspberry_id, limit))
-    
-    columns = ['id', 'timestamp', 'detection_count', 'image_filename',
-               'image_url', 'temperature', 'humidity']
-    data = [dict(zip(columns, row)) for row in cursor.fetchall()]
-    conn.close()
+    cached = not_modified(request, response)
+    if cached:
+        return cached
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(RPI_IMAGES_SQL, (raspberry_id, limit))
+        
+        if columnar:
+            return {"raspberry_id": raspberry_id, **rows_as_columns(cursor)}
+        data = [dict(row) for row in cursor.fetchall()]
     
     return {"raspberry_id": raspberry_id, "images": data}
 
 @app.get("/api/latest-data")
-async def get_latest_data(limit: int = 50):
+def get_latest_data(
+    request: Request,
+    response: Response,
+    limit: int = 50,
+    before: str = Query(None),  # timestamp del último registro de la página anterior
+    columnar: bool = False
+):
     """Obtener datos más recientes de todos los Raspberry Pi"""
-    conn = sqlite3.connect('raspberry_data.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT * FROM detections 
-        ORDER BY timestamp DESC 
-        LIMIT ?
-    ''', (limit,))
-    
-    columns = ['id', 'raspberry_id', 'timestamp', 'detection_count',
-               'temperature', 'humidity', 'latitude', 'longitude',
-               'image_filename', 'image_url', 'created_at']
-    data = [dict(zip(columns, row)) for row in cursor.fetchall()]
-    conn.close()
+    cached = not_modified(request, response)
+    if cached:
+        return cached
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        if before:
+            cursor.execute(LATEST_DATA_BEFORE_SQL, (before, limit))
+        else:
+            cursor.execute(LATEST_DATA_SQL, (limit,))
+        
+        if columnar:
+            return rows_as_columns(cursor)
+        data = [dict(row) for row in cursor.fetchall()]
     
     return {"data": data}
 
-@app.get("/api/statistics")
-async def get_statistics():
-    """Obtener estadísticas generales"""
-    conn = sqlite3.connect('raspberry_data.db')
-    cursor = conn.cursor()
-    
-    # Estadísticas básicas
-    cursor.execute('SELECT COUNT(*) FROM detections')
-    total_detections = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT COUNT(DISTINCT raspberry_id) FROM detections')
-    active_raspberries = cursor.fetchone()[0]
-    
-    cursor.execute('SELECT AVG(temperature) FROM detections WHERE temperature IS NOT NULL')
-    avg_temp = cursor.fetchone()[0] or 0
-    
-    cursor.execute('SELECT AVG(humidity) FROM detections WHERE humidity IS NOT NULL')
-    avg_humidity = cursor.fetchone()[0] or 0
+def load_statistics():
+    with get_conn() as conn:
+        cursor = conn.cursor()
+        cursor.execute(STATS_BY_PI_SQL)
+        rows = cursor.fetchall()
     
     # Detecciones por Raspberry Pi
-    cursor.execute('''
-        SELECT raspberry_id, COUNT(*) as count
-        FROM detections
-        GROUP BY raspberry_id
-        ORDER BY count DESC
-    ''')
-    detections_by_pi = dict(cursor.fetchall())
+    detections_by_pi = {row['raspberry_id']: row['count'] for row in rows}
     
-    conn.close()
+    # Estadísticas básicas
+    total_detections = sum(row['count'] for row in rows)
+    active_raspberries = sum(1 for row in rows if row['raspberry_id'] is not None)
+    temperature_count = sum(row['temperature_count'] for row in rows)
+    humidity_count = sum(row['humidity_count'] for row in rows)
+    avg_temp = sum(row['temperature_sum'] or 0 for row in rows) / temperature_count if temperature_count else 0
+    avg_humidity = sum(row['humidity_sum'] or 0 for row in rows) / humidity_count if humidity_count else 0
     
     return {
         "total_detections": total_detections,
@@ -286,36 +560,44 @@ async def get_statistics():
         "detections_by_pi": detections_by_pi
     }
 
+@app.get("/api/statistics")
+def get_statistics(request: Request, response: Response):
+    """Obtener estadísticas generales"""
+    cached = not_modified(request, response)
+    if cached:
+        return cached
+    return cached_by_version("statistics", load_statistics)
+
 # Endpoint para verificar si una imagen existe
 @app.get("/api/image-exists/{image_filename}")
 async def check_image_exists(image_filename: str):
     """Verificar si una imagen existe"""
-    image_path = os.path.join(IMAGES_DIR, image_filename)
-    exists = os.path.exists(image_path)
+    image_path, _ = await run_in_threadpool(locate_image, image_filename)
     
     return {
         "filename": image_filename,
-        "exists": exists,
-        "path": image_path if exists else None
+        "exists": image_path is not None,
+        "path": image_path
     }
 
 # Endpoint alternativo para servir imágenes (por si acaso)
 @app.get("/api/image/{image_filename}")
 async def get_image_file(image_filename: str):
     """Servir imagen específica"""
-    image_path = os.path.join(IMAGES_DIR, image_filename)
-    
-    if not os.path.exists(image_path):
+    # El stat sirve para el 404 y FileResponse no vuelve a hacerlo
+    image_path, stat_result = await run_in_threadpool(locate_image, image_filename)
+    if image_path is None:
         raise HTTPException(status_code=404, detail="Image not found")
     
     return FileResponse(
         image_path,
         media_type="image/jpeg",
-        headers={"Cache-Control": "max-age=3600"}
+        headers={"Cache-Control": IMAGE_CACHE_CONTROL},
+        stat_result=stat_result
     )
 
 @app.delete("/api/delete-data")
-async def delete_data(
+def delete_data(
     admin_key: str = Header(...), # Para recibir tokens, API keys o claves
     raspberry_id: str = Query(None),
     start_date: str = Query(None),  # formato: "2024-01-01"
@@ -324,38 +606,43 @@ async def delete_data(
     if admin_key != "SECRET123":
         raise HTTPException(status_code=403, detail="No autorizado")
 
-    conn = sqlite3.connect("raspberry_data.db")
-    cursor = conn.cursor()
+    if start_date and end_date:
+        # Rango semiabierto [start_date, end_date + 1 día) sobre el timestamp ISO,
+        # así la condición puede usar el índice de timestamp
+        try:
+            range_start = date.fromisoformat(start_date).isoformat()
+            range_end = (date.fromisoformat(end_date) + timedelta(days=1)).isoformat()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Formato de fecha inválido, use YYYY-MM-DD")
 
-    try:
-        # 🔁 Caso 1: Borrar por rango de fechas
-        if start_date and end_date:
-            cursor.execute('''
-                DELETE FROM detections
-                WHERE DATE(timestamp) BETWEEN ? AND ?
-            ''', (start_date, end_date))
-            conn.commit()
-            return {"status": "success", "message": f"Se eliminaron datos entre {start_date} y {end_date}"}
-
-        # 🎯 Caso 2: Borrar por Raspberry ID
-        elif raspberry_id:
-            cursor.execute("DELETE FROM detections WHERE raspberry_id = ?", (raspberry_id,))
-            cursor.execute("DELETE FROM raspberry_info WHERE raspberry_id = ?", (raspberry_id,))
-            conn.commit()
-            return {"status": "success", "message": f"Datos eliminados para {raspberry_id}"}
-
-        # 🧹 Caso 3: Borrar todo
-        else:
-            cursor.execute("DELETE FROM detections")
-            cursor.execute("DELETE FROM raspberry_info")
-            conn.commit()
-            return {"status": "success", "message": "Todos los datos han sido eliminados"}
+    with get_conn() as conn:
+        cursor = conn.cursor()
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error al eliminar datos: {str(e)}")
-    finally:
-        conn.close()
+        try:
+            with transaction(conn):
+                # 🔁 Caso 1: Borrar por rango de fechas
+                if start_date and end_date:
+                    cursor.execute('''
+                        DELETE FROM detections
+                        WHERE timestamp >= ? AND timestamp < ?
+                    ''', (range_start, range_end))
+                    cursor.execute(REFRESH_RPI_TOTALS_SQL)
+                    return {"status": "success", "message": f"Se eliminaron datos entre {start_date} y {end_date}"}
+
+                # 🎯 Caso 2: Borrar por Raspberry ID
+                elif raspberry_id:
+                    cursor.execute("DELETE FROM detections WHERE raspberry_id = ?", (raspberry_id,))
+                    cursor.execute("DELETE FROM raspberry_info WHERE raspberry_id = ?", (raspberry_id,))
+                    return {"status": "success", "message": f"Datos eliminados para {raspberry_id}"}
+
+                # 🧹 Caso 3: Borrar todo
+                else:
+                    cursor.execute("DELETE FROM detections")
+                    cursor.execute("DELETE FROM raspberry_info")
+                    return {"status": "success", "message": "Todos los datos han sido eliminados"}
 
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error al eliminar datos: {str(e)}")
 
 if __name__ == "__main__":
     print("🍓 Iniciando servidor FastAPI para Raspberry Pi...")